@@ -1,21 +1,36 @@
 # Copyright (C) 2023 Intel Corporation
 # SPDX-License-Identifier:  BSD-3-Clause
 
+import contextlib
 import json
 import os
-from typing import Any, Dict, Tuple
+import tempfile
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 from PIL import Image
 from PIL.Image import Transpose
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 
 from ..boundingbox import utils as bbutils
 from ..boundingbox.utils import Height, Width
 
+try:
+    # faster JSON parser used for the label files when it is available.
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+try:
+    # libjpeg-turbo decoder is used for JPEG frames when it is available.
+    from turbojpeg import TJPF_RGB, TurboJPEG
+    _turbo_jpeg = TurboJPEG()
+except (ModuleNotFoundError, RuntimeError, OSError):
+    _turbo_jpeg = None
+
 """BDD100K object detection dataset module."""
 
 
@@ -39,6 +54,30 @@ def removesuffix(input_string: str, suffix: str) -> str:
     return input_string
 
 
+def read_json(path: str) -> Any:
+    """Reads a JSON file. orjson is used if it is installed.
+
+    Parameters
+    ----------
+    path : str
+        Path of the JSON file.
+
+    Returns
+    -------
+    Any
+        Decoded JSON content.
+    """
+    with open(path, 'rb') as file:
+        if orjson is not None:
+            return orjson.loads(file.read())
+        return json.load(file)
+
+
+# Label summary cached in the label folder after the first scan. It does
+# not use the .json suffix so that it is not mistaken for a label file.
+INDEX_FILE = '.bdd_index.cache'
+
+
 class _BDD(Dataset):
     # Low level BDD100K dataset. To be wrapped around, do not use externally.
     def __init__(self,
@@ -46,10 +85,12 @@ class _BDD(Dataset):
                  dataset: str = '.',
                  train: bool = False,
                  seq_len: int = 32,
-                 randomize_seq: bool = False) -> None:
+                 randomize_seq: bool = False,
+                 size: Optional[Tuple[Height, Width]] = None) -> None:
         super().__init__()
         self.seq_len = seq_len
         self.randomize_seq = randomize_seq
+        self.size = size
 
         image_set = 'train' if train else 'val'
         self.label_path = root + os.sep + \
@@ -69,29 +110,104 @@ class _BDD(Dataset):
         json_files = [label_json for label_json in os.listdir(
             self.label_path) if label_json.endswith('.json')]
 
-        categories = set()
-        for json_file in json_files:
-            with open(self.label_path + os.sep + json_file) as file:
-                data = json.load(file)
-                for img in data:
-                    for cat in img['labels']:
-                        categories.add(cat['category'])
-
         self.ids = [removesuffix(name, '.json') for name in json_files]
-        self.cat_name = sorted(list(categories))
+        self.cat_name = self._categories(json_files)
         self.idx_map = {name: idx for idx, name in enumerate(self.cat_name)}
 
+    def _categories(self, json_files: List[str]) -> List[str]:
+        # The categories are read from the index file if it is consistent
+        # with the modification time and size of every label file.
+        # Otherwise, all the label files are scanned and the index file is
+        # rewritten.
+        index_path = self.label_path + INDEX_FILE
+        files = {}
+        for json_file in json_files:
+            stat = os.stat(self.label_path + os.sep + json_file)
+            files[json_file] = [stat.st_mtime_ns, stat.st_size]
+        try:
+            with open(index_path) as file:
+                index = json.load(file)
+            if index['files'] == files:
+                return index['cat_name']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # missing, corrupt or stale index, it is rebuilt below
+
+        def file_categories(json_file: str) -> Set[str]:
+            data = read_json(self.label_path + os.sep + json_file)
+            return {cat['category'] for img in data for cat in img['labels']}
+
+        with ThreadPoolExecutor() as pool:
+            categories = set().union(*pool.map(file_categories, json_files))
+        cat_name = sorted(list(categories))
+
+        # Written to a temporary file first and then moved in place so that
+        # concurrent readers never see a partially written index.
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.label_path,
+                                            prefix=INDEX_FILE,
+                                            suffix='.tmp')
+        except OSError:
+            return cat_name  # read only dataset, labels are scanned every time
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump({'files': files, 'cat_name': cat_name}, file)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+        return cat_name
+
+    def _read_labels(self, id: str) -> List[Tuple[str, Tuple[Any, ...]]]:
+        # Only the frame names and the boxes are kept.
+        data = read_json(self.label_path + os.sep + id + '.json')
+        return [(img['name'],
+                 tuple((ann['category'],
+                        (ann['box2d']['x1'], ann['box2d']['y1'],
+                         ann['box2d']['x2'], ann['box2d']['y2']))
+                       for ann in img['labels']))
+                for img in data]
+
+    def _scaling_factor(self, width: int,
+                        height: int) -> Optional[Tuple[int, int]]:
+        # Smallest TurboJPEG scaling factor that keeps the decoded frame at
+        # least the desired size. None means no scaling.
+        if self.size is None:
+            return None
+        factor = None
+        for num, denom in _turbo_jpeg.scaling_factors:
+            if num >= denom:
+                continue
+            if -(-width * num // denom) < self.size[1] \
+                    or -(-height * num // denom) < self.size[0]:
+                continue
+            if factor is None or num * factor[1] < factor[0] * denom:
+                factor = (num, denom)
+        return factor
+
     def _get_frame(self, path, labels):
-        image = Image.open(path).convert('RGB')
-        width, height = image.size
+        is_jpeg = path.lower().endswith(('.jpg', '.jpeg'))
+        # Both decoders downscale in DCT domain as long as the frame stays
+        # at least the desired size. Pillow only scales by 1/2, 1/4 and 1/8,
+        # so it only helps when the desired size is at most half of the
+        # source resolution in both dimensions. TurboJPEG also supports the
+        # finer factors of its libjpeg-turbo build (multiples of 1/8).
+        if _turbo_jpeg is not None and is_jpeg:
+            with open(path, 'rb') as file:
+                buffer = file.read()
+            width, height, _, _ = _turbo_jpeg.decode_header(buffer)
+            image = Image.fromarray(_turbo_jpeg.decode(
+                buffer, pixel_format=TJPF_RGB,
+                scaling_factor=self._scaling_factor(width, height)))
+        else:
+            image = Image.open(path)
+            width, height = image.size
+            if self.size is not None:
+                image.draft('RGB', (self.size[1], self.size[0]))
+            image = image.convert('RGB')
         size = {'height': height, 'width': width}
         objects = []
-        for ann in labels:
-            name = ann['category']
-            bndbox = {'xmin': ann['box2d']['x1'],
-                      'ymin': ann['box2d']['y1'],
-                      'xmax': ann['box2d']['x2'],
-                      'ymax': ann['box2d']['y2']}
+        for name, (x1, y1, x2, y2) in labels:
+            bndbox = {'xmin': x1, 'ymin': y1, 'xmax': x2, 'ymax': y2}
             objects.append({'id': self.idx_map[name],
                             'name': name,
                             'bndbox': bndbox})
@@ -105,23 +221,20 @@ class _BDD(Dataset):
 
         images = []
         annotations = []
-        with open(self.label_path + os.sep + id + '.json') as file:
-            data = json.load(file)
-            num_seq = len(data)
-            if self.randomize_seq:
-                start_idx = np.random.randint(max(num_seq - self.seq_len, 0))
-            else:
-                start_idx = 0
-            stop_idx = start_idx + self.seq_len
-            data = data[start_idx:stop_idx]
-
-            with ThreadPoolExecutor() as pool:
-                path = map(lambda img: img_path + os.sep + img['name'], data)
-                labels = map(lambda img: img['labels'], data)
-                for image, annotation in pool.map(self._get_frame,
-                                                  path, labels):
-                    images.append(image)
-                    annotations.append(annotation)
+        data = self._read_labels(id)
+        num_seq = len(data)
+        if self.randomize_seq:
+            start_idx = np.random.randint(max(num_seq - self.seq_len, 0))
+        else:
+            start_idx = 0
+        stop_idx = start_idx + self.seq_len
+        data = data[start_idx:stop_idx]
+
+        for name, labels in data:
+            image, annotation = self._get_frame(img_path + os.sep + name,
+                                                labels)
+            images.append(image)
+            annotations.append(annotation)
         if len(images) != self.seq_len:
             delta = self.seq_len - len(images)
             images = images + [images[-1]] * delta
@@ -141,10 +254,15 @@ class BDD(Dataset):
                  train: bool = False,
                  seq_len: int = 32,
                  randomize_seq: bool = False,
-                 augment_prob: float = 0.0) -> None:
+                 augment_prob: float = 0.0,
+                 return_numpy: bool = False) -> None:
         """Berkley Deep Drive (BDD100K) dataset module. For details on the
         dataset, refer to: https://bdd-data.berkeley.edu/.
 
+        Note: a sample is decoded and augmented sequentially. Use multiple
+        DataLoader worker processes to load samples in parallel, for example
+        with ``get_dataloader``.
+
         Parameters
         ----------
         root : str, optional
@@ -164,30 +282,40 @@ class BDD(Dataset):
         augment_prob : float, optional
             Augmentation probability of the frames and bounding boxes,
             by default 0.0.
+        return_numpy : bool, optional
+            Return the frame sequence as numpy array instead of torch tensor,
+            by default False.
         """
         super().__init__()
         self.blur = transforms.GaussianBlur(kernel_size=5)
         self.color_jitter = transforms.ColorJitter()
         self.grayscale = transforms.Grayscale(num_output_channels=3)
-        self.img_transform = transforms.Compose([transforms.Resize(size),
-                                                 transforms.ToTensor()])
+        # resize is applied before any augmentation so that they operate
+        # on the smaller frame
+        self.pre_resize = transforms.Resize(size)
+        # uint8 tensor, it is scaled to [0, 1] once for the whole sequence
+        self.to_tensor = transforms.PILToTensor()
         self.bb_transform = transforms.Compose([
             lambda x: bbutils.resize_bounding_boxes(x, size),
         ])
 
         self.datasets = [_BDD(root=root, dataset=dataset, train=train,
-                              seq_len=seq_len, randomize_seq=randomize_seq)]
+                              seq_len=seq_len, randomize_seq=randomize_seq,
+                              size=size)]
 
         self.classes = self.datasets[0].cat_name
         self.idx_map = self.datasets[0].idx_map
         self.augment_prob = augment_prob
         self.seq_len = seq_len
         self.randomize_seq = randomize_seq
+        self.return_numpy = return_numpy
 
     def flip_lr(self, img) -> Image:
         return Image.Image.transpose(img, Transpose.FLIP_LEFT_RIGHT)
 
-    def __getitem__(self, index: int) -> Tuple[torch.tensor, Dict[Any, Any]]:
+    def __getitem__(
+        self, index: int
+    ) -> Tuple[Union[torch.tensor, np.ndarray], Dict[Any, Any]]:
         """Get a sample video sequence of BDD100K dataset.
 
         Parameters
@@ -197,41 +325,97 @@ class BDD(Dataset):
 
         Returns
         -------
-        Tuple[torch.tensor, Dict[Any, Any]]
-            Frame sequence and dictionary of bounding box annotations.
+        Tuple[Union[torch.tensor, np.ndarray], Dict[Any, Any]]
+            Frame sequence (CHWT) and dictionary of bounding box annotations.
+            The frame sequence is a numpy array if return_numpy is set.
         """
         dataset_idx = index // len(self.datasets[0])
         index = index % len(self.datasets[0])
         images, annotations = self.datasets[dataset_idx][index]
 
-        # flip left right
-        if np.random.random() < self.augment_prob:
-            with ThreadPoolExecutor() as pool:
-                images = pool.map(self.flip_lr, images)
-            with ThreadPoolExecutor() as pool:
-                annotations = pool.map(bbutils.fliplr_bounding_boxes,
-                                       annotations)
-        # blur
-        if np.random.random() < self.augment_prob:
-            with ThreadPoolExecutor() as pool:
-                images = pool.map(self.blur, images)
-        # color jitter
-        if np.random.random() < self.augment_prob:
-            with ThreadPoolExecutor() as pool:
-                images = pool.map(self.color_jitter, images)
-        # grayscale
-        if np.random.random() < self.augment_prob:
-            with ThreadPoolExecutor() as pool:
-                images = pool.map(self.grayscale, images)
-
-        with ThreadPoolExecutor() as pool:
-            results = pool.map(self.img_transform, images)
-            image = torch.stack(list(results), dim=-1)
+        # augmentation decisions are sampled once for the whole sequence
+        flip, blur, jitter, gray = np.random.random(4) < self.augment_prob
+
+        def transform(img: Image) -> torch.tensor:
+            img = self.pre_resize(img)
+            if flip:
+                img = self.flip_lr(img)
+            if blur:
+                img = self.blur(img)
+            if jitter:
+                img = self.color_jitter(img)
+            if gray:
+                img = self.grayscale(img)
+            return self.to_tensor(img)
+
+        # the uint8 frames are stacked first and converted to float once
+        image = torch.stack([transform(img) for img in images], dim=-1)
+        image = image.float().div_(255)
+        if flip:
+            annotations = map(bbutils.fliplr_bounding_boxes, annotations)
         annotations = list(map(self.bb_transform, annotations))
 
+        if self.return_numpy:
+            return image.numpy(), annotations
         return image, annotations
 
     def __len__(self) -> int:
         """Number of samples in the dataset.
         """
         return sum([len(dataset) for dataset in self.datasets])
+
+
+def _init_worker(worker_id: int) -> None:
+    # One intra-op thread per worker process to avoid oversubscription.
+    torch.set_num_threads(1)
+
+
+def get_dataloader(dataset: Dataset,
+                   batch_size: int = 1,
+                   shuffle: bool = False,
+                   collate_fn: Optional[Callable] = None,
+                   num_workers: Optional[int] = None,
+                   prefetch_factor: int = 4,
+                   pin_memory: bool = True,
+                   **kwargs: Any) -> DataLoader:
+    """Creates a DataLoader that loads the dataset samples in parallel with
+    persistent worker processes, each running a single torch thread.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        Dataset module, e.g. BDD.
+    batch_size : int, optional
+        Batch size, by default 1.
+    shuffle : bool, optional
+        Shuffle the samples every epoch, by default False.
+    collate_fn : Optional[Callable], optional
+        Batch collate function, by default None.
+    num_workers : Optional[int], optional
+        Number of worker processes. If None, min(8, cpu_count) is used.
+        By default None.
+    prefetch_factor : int, optional
+        Number of batches prefetched by each worker, by default 4.
+    pin_memory : bool, optional
+        Return batches in pinned memory, by default True.
+    **kwargs : Any
+        Additional keyword arguments passed to the DataLoader.
+
+    Returns
+    -------
+    DataLoader
+        Dataloader of the dataset.
+    """
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    if num_workers > 0:
+        kwargs.setdefault('persistent_workers', True)
+        kwargs.setdefault('worker_init_fn', _init_worker)
+        kwargs['prefetch_factor'] = prefetch_factor
+    return DataLoader(dataset,
+                      batch_size=batch_size,
+                      shuffle=shuffle,
+                      collate_fn=collate_fn,
+                      num_workers=num_workers,
+                      pin_memory=pin_memory,
+                      **kwargs)
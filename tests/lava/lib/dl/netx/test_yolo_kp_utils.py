@@ -0,0 +1,217 @@
+# Copyright (C) 2023 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+# See: https://spdx.org/licenses/
+
+import importlib.util
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+
+verbose = True if (('-v' in sys.argv) or ('--verbose' in sys.argv)) else False
+root = os.path.dirname(os.path.abspath(__file__))
+utils_path = os.path.join(root, '..', '..', '..', '..', '..', 'tutorials',
+                          'lava', 'lib', 'dl', 'netx', 'yolo_kp', 'utils.py')
+spec = importlib.util.spec_from_file_location('yolo_kp_utils', utils_path)
+yolo_utils = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(yolo_utils)
+
+seed = np.random.randint(1000)
+np.random.seed(seed)
+if verbose:
+    print(f'{seed=}')
+
+anchors = np.array([(0.28, 0.22), (0.38, 0.48), (0.9, 0.78)])
+
+
+def reference_yolo(x: np.ndarray, anchors: np.ndarray,
+                   clamp_max: float) -> np.ndarray:
+    # Reference YOLO prediction formulation.
+    W, H, C = x.shape
+    A = anchors.shape[0]
+    P = C // A
+    x = x.reshape([W, H, A, P]).transpose([2, 1, 0, 3])
+    range_y, range_x = np.meshgrid(np.arange(H), np.arange(W), indexing='ij')
+    anchor_x, anchor_y = anchors[:, 0], anchors[:, 1]
+
+    def sigmoid(x):
+        return 1.0 / (1.0 + np.exp(-x))
+
+    x_center = (sigmoid(x[..., 0:1]) + range_x[None, :, :, None]) / W
+    y_center = (sigmoid(x[..., 1:2]) + range_y[None, :, :, None]) / H
+    width = (np.exp(x[..., 2:3].clip(max=clamp_max))
+             * anchor_x[:, None, None, None]) / W
+    height = (np.exp(x[..., 3:4].clip(max=clamp_max))
+              * anchor_y[:, None, None, None]) / H
+    confidence = sigmoid(x[..., 4:5])
+    classes = np.exp(x[..., 5:]) / np.sum(np.exp(x[..., 5:]),
+                                          axis=-1, keepdims=True)
+    x = np.concatenate([x_center, y_center, width, height,
+                        confidence, classes], axis=-1)
+    return x.reshape([-1, P])
+
+
+class ReferenceDeltaEncoder:
+    # Reference DeltaEncoder formulation.
+    def __init__(self, vth, spike_exp=0, num_bits=None):
+        self.vth = vth * (1 << (spike_exp))
+        self.spike_exp = spike_exp
+        self.residue = 0
+        self.act = 0
+        if num_bits is not None:
+            self.a_min = -(1 << (num_bits - 1)) << spike_exp
+            self.a_max = ((1 << (num_bits - 1)) - 1) << spike_exp
+        else:
+            self.a_min = self.a_max = -1
+
+    def __call__(self, a_in):
+        act_new = np.left_shift(a_in, self.spike_exp)
+        delta = act_new - self.act + self.residue
+        s_out = np.where(np.abs(delta) >= self.vth, delta, 0)
+        if self.a_max > 0:
+            s_out = np.clip(s_out, a_min=self.a_min, a_max=self.a_max)
+        self.residue = delta - s_out
+        self.act = act_new
+        return s_out
+
+
+def predictor_paths():
+    paths = [False]
+    if yolo_utils.HAVE_NUMBA:
+        paths.append(True)
+    return paths
+
+
+class TestYOLOPredictor(unittest.TestCase):
+    def test_against_reference(self):
+        """Tests YOLOPredictor against reference formulation."""
+        for numba in predictor_paths():
+            for dtype in [np.float32, np.float64, np.int64]:
+                x = (np.random.randn(14, 12, 3 * 16) * 4).astype(dtype)
+                with mock.patch.object(yolo_utils, 'HAVE_NUMBA', numba):
+                    pred = yolo_utils.YOLOPredictor(anchors, clamp_max=5)(x)
+                ref = reference_yolo(x, anchors, 5)
+                if verbose:
+                    print(f'{numba=}, {dtype=}, '
+                          f'error={np.abs(pred - ref).max()}')
+                self.assertEqual(pred.shape, ref.shape)
+                self.assertEqual(pred.dtype, ref.dtype)
+                self.assertTrue(np.allclose(pred, ref, rtol=1e-5, atol=1e-6),
+                                f'Mismatch for {numba=}, {dtype=}.')
+
+    def test_no_classes(self):
+        """Tests YOLOPredictor without class channels."""
+        x = np.random.randn(5, 4, 3 * 5)
+        ref = reference_yolo(x, anchors, 5)
+        for numba in predictor_paths():
+            with mock.patch.object(yolo_utils, 'HAVE_NUMBA', numba):
+                pred = yolo_utils.YOLOPredictor(anchors, clamp_max=5)(x)
+            self.assertTrue(np.allclose(pred, ref),
+                            f'Mismatch for {numba=}.')
+
+    def test_anchor_dtype(self):
+        """Tests both paths return the same dtype for float32 anchors."""
+        x = np.random.randn(5, 4, 3 * 8).astype(np.float32)
+        dtypes = []
+        for numba in predictor_paths():
+            with mock.patch.object(yolo_utils, 'HAVE_NUMBA', numba):
+                predictor = yolo_utils.YOLOPredictor(
+                    anchors.astype(np.float32), clamp_max=5)
+                dtypes.append(predictor(x).dtype)
+        self.assertTrue(all(dtype == np.float64 for dtype in dtypes),
+                        f'Expected float64 outputs. Found {dtypes}.')
+
+
+class TestDeltaEncoder(unittest.TestCase):
+    def run_encoders(self, inputs, **kwargs):
+        # returns the arithmetic dtype of the encoders after the inputs
+        dtypes = []
+        for numba in predictor_paths():
+            ref = ReferenceDeltaEncoder(**kwargs)
+            with mock.patch.object(yolo_utils, 'HAVE_NUMBA', numba):
+                encoder = yolo_utils.DeltaEncoder(**kwargs)
+                for t, a_in in enumerate(inputs):
+                    s_out = encoder.forward(a_in)
+                    s_ref = ref(a_in)
+                    self.assertTrue(np.array_equal(s_out, s_ref),
+                                    f'Mismatch at {t=} for {numba=}, '
+                                    f'{kwargs=}. Found {s_out} and {s_ref}.')
+            dtypes.append(encoder.dtype)
+        return dtypes
+
+    def test_against_reference(self):
+        """Tests DeltaEncoder against reference formulation."""
+        low = [np.random.randint(-100, 100, size=(8, 6, 3))
+               for _ in range(10)]
+        high = [np.random.randint(-300, 300, size=(8, 6, 3))
+                for _ in range(10)]
+        self.run_encoders(low, vth=3, spike_exp=6, num_bits=8)
+        self.run_encoders(low + high, vth=3, spike_exp=6, num_bits=8)
+        self.run_encoders(high, vth=3, spike_exp=6)
+        self.run_encoders([a.astype(np.int16) for a in low],
+                          vth=3, spike_exp=6, num_bits=8)
+
+    def test_narrowed(self):
+        """Tests DeltaEncoder stays in int16 while the input span fits."""
+        # quantized normalized frames similar to the yolo_kp tutorial
+        frames = [np.random.randint(-135, 170, size=(16, 16, 3))
+                  for _ in range(10)]
+        dtypes = self.run_encoders(frames, vth=3, spike_exp=4, num_bits=8)
+        self.assertTrue(all(dtype == np.int16 for dtype in dtypes),
+                        f'Expected int16 arithmetic. Found {dtypes}.')
+        # input span close to the int16 limit with heavy clipping
+        large = [np.random.randint(-16000, 16000, size=(64,))
+                 for _ in range(20)]
+        for num_bits in [None, 8]:
+            dtypes = self.run_encoders(large, vth=5, num_bits=num_bits)
+            self.assertTrue(all(dtype == np.int16 for dtype in dtypes),
+                            f'Expected int16 arithmetic. Found {dtypes}.')
+
+    def test_no_overflow(self):
+        """Tests DeltaEncoder does not overflow without num_bits."""
+        dtypes = self.run_encoders([np.array([3000])], vth=1, spike_exp=4)
+        self.assertTrue(all(dtype is None for dtype in dtypes),
+                        f'Expected input dtype fall back. Found {dtypes}.')
+        large = [np.random.randint(-30000, 30000, size=(16,))
+                 for _ in range(10)]
+        self.run_encoders(large, vth=1, spike_exp=0)
+
+    def test_invalid_input(self):
+        """Tests DeltaEncoder rejects non-integer input."""
+        encoder = yolo_utils.DeltaEncoder(vth=1, spike_exp=4)
+        with self.assertRaises(TypeError):
+            encoder.forward(np.array([1.5]))
+
+    def test_dtype_range(self):
+        """Tests DeltaEncoder range checks of explicit dtype."""
+        with self.assertRaises(RuntimeError):
+            yolo_utils.DeltaEncoder(vth=1, spike_exp=10, num_bits=8,
+                                    dtype=np.int16)
+        encoder = yolo_utils.DeltaEncoder(vth=1, spike_exp=4, dtype=np.int16)
+        with self.assertRaises(RuntimeError):
+            encoder.forward(np.array([3000]))
+
+
+class TestHelpers(unittest.TestCase):
+    def test_softmax(self):
+        """Tests softmax against reference formulation."""
+        x = np.random.randn(6, 7) * 5
+        for axis in [None, 0, -1]:
+            ref = np.exp(x) / np.sum(np.exp(x), axis=axis, keepdims=True)
+            self.assertTrue(np.allclose(yolo_utils.softmax(x, axis=axis),
+                                        ref))
+        large = yolo_utils.softmax(np.array([1000., 1001.]))
+        self.assertTrue(np.all(np.isfinite(large)))
+
+    def test_sigmoid(self):
+        """Tests sigmoid against reference formulation."""
+        x = np.random.randn(6, 7) * 5
+        ref = 1.0 / (1.0 + np.exp(-x))
+        self.assertTrue(np.allclose(yolo_utils.sigmoid(x), ref))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# Copyright (C) 2023 Intel Corporation
+# SPDX-License-Identifier:  BSD-3-Clause
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from lava.lib.dl.slayer.object_detection.dataset import bdd100k
+
+verbose = True if (("-v" in sys.argv) or ("--verbose" in sys.argv)) else False
+
+
+def labels(categories):
+    return [{'name': 'frame.jpg',
+             'labels': [{'category': category,
+                         'box2d': {'x1': 0, 'y1': 0, 'x2': 1, 'y2': 1}}
+                        for category in categories]}]
+
+
+class TestBDDIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        self.label_path = os.path.join(self.root, 'labels', 'box_track_20',
+                                       'val')
+        os.makedirs(self.label_path)
+        os.makedirs(os.path.join(self.root, 'images', 'track', 'val'))
+        self.write_labels('seq0', ['car', 'bus'])
+        self.write_labels('seq1', ['pedestrian'])
+        self.index_path = os.path.join(self.label_path, bdd100k.INDEX_FILE)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_labels(self, id, categories):
+        with open(os.path.join(self.label_path, id + '.json'), 'w') as file:
+            json.dump(labels(categories), file)
+
+    def dataset(self):
+        return bdd100k._BDD(root=self.root, dataset='track')
+
+    def test_fresh_build(self):
+        """Tests the index is written on the first scan."""
+        dataset = self.dataset()
+        if verbose:
+            print(f'{dataset.cat_name=}')
+        self.assertEqual(dataset.cat_name, ['bus', 'car', 'pedestrian'])
+        self.assertEqual(sorted(dataset.ids), ['seq0', 'seq1'])
+        self.assertTrue(os.path.isfile(self.index_path))
+        # only the label files are listed as json files
+        self.assertEqual(sorted(name for name in os.listdir(self.label_path)
+                                if name.endswith('.json')),
+                         ['seq0.json', 'seq1.json'])
+        self.assertEqual(len(os.listdir(self.label_path)), 3,
+                         'Expected no temporary files to be left behind.')
+
+    def test_cache_hit(self):
+        """Tests the label files are not scanned with a valid index."""
+        self.dataset()
+        with mock.patch.object(bdd100k, 'read_json',
+                               side_effect=AssertionError('scanned')):
+            dataset = self.dataset()
+        self.assertEqual(dataset.cat_name, ['bus', 'car', 'pedestrian'])
+
+    def test_corrupt_index(self):
+        """Tests a corrupt index is rebuilt."""
+        self.dataset()
+        with open(self.index_path, 'w') as file:
+            file.write('{"files": {')
+        dataset = self.dataset()
+        self.assertEqual(dataset.cat_name, ['bus', 'car', 'pedestrian'])
+        with open(self.index_path) as file:
+            self.assertEqual(json.load(file)['cat_name'], dataset.cat_name)
+
+    def test_edited_labels(self):
+        """Tests an edited label file invalidates the index."""
+        self.dataset()
+        self.write_labels('seq1', ['pedestrian', 'truck'])
+        dataset = self.dataset()
+        self.assertEqual(dataset.cat_name,
+                         ['bus', 'car', 'pedestrian', 'truck'])
+        self.write_labels('seq2', ['bicycle'])
+        dataset = self.dataset()
+        self.assertEqual(dataset.cat_name,
+                         ['bicycle', 'bus', 'car', 'pedestrian', 'truck'])
+
+    def test_read_only(self):
+        """Tests the categories are scanned when the index can't be written.
+        """
+        with mock.patch.object(bdd100k.tempfile, 'mkstemp',
+                               side_effect=PermissionError):
+            dataset = self.dataset()
+        self.assertEqual(dataset.cat_name, ['bus', 'car', 'pedestrian'])
+        self.assertFalse(os.path.exists(self.index_path))
+        self.assertEqual(len(os.listdir(self.label_path)), 2)
+
+
+class TestBDDScalingFactor(unittest.TestCase):
+    # scaling factors reported by libjpeg-turbo
+    scaling_factors = frozenset([(2, 1), (15, 8), (7, 4), (13, 8), (3, 2),
+                                 (11, 8), (5, 4), (9, 8), (1, 1), (7, 8),
+                                 (3, 4), (5, 8), (1, 2), (3, 8), (1, 4),
+                                 (1, 8)])
+
+    def scaling_factor(self, size, width=1280, height=720):
+        dataset = bdd100k._BDD.__new__(bdd100k._BDD)
+        dataset.size = size
+        turbo_jpeg = mock.Mock(scaling_factors=self.scaling_factors)
+        with mock.patch.object(bdd100k, '_turbo_jpeg', turbo_jpeg):
+            return dataset._scaling_factor(width, height)
+
+    def test_downscale(self):
+        """Tests the smallest factor that keeps the desired size."""
+        self.assertEqual(self.scaling_factor((448, 448)), (5, 8))
+
+    def test_no_downscale(self):
+        """Tests no scaling for a desired size at or above the source."""
+        self.assertIsNone(self.scaling_factor((720, 1280)))
+        self.assertIsNone(self.scaling_factor((1080, 1920)))
+        self.assertIsNone(self.scaling_factor(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
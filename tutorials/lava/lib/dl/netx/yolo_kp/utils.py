@@ -1,21 +1,29 @@
 # Copyright (C) 2023 Intel Corporation
 # SPDX-License-Identifier:  BSD-3-Clause
 
-from typing import Iterable, Optional, List, Callable, Union
+from typing import Iterable, Optional, List, Callable, Tuple, Union
 from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
 
 from lava.lib.dl.netx.sequential_modules import AbstractSeqModule
 from lava.lib.dl.slayer import obd
 
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ModuleNotFoundError:
+    HAVE_NUMBA = False
+
 
 class DataGenerator(AbstractSeqModule):
     """Datagenerator module for Object detection. On every call, it
     returns an RGB frame (with normalization applied), ground truth
     annotation, and the raw frame.
 
-    Next sample is automatically loaded when the buffer is empty.
+    Next sample is automatically loaded when the buffer is empty. It is
+    prefetched in the background while the current sample is consumed.
 
     Parameters
     ----------
@@ -41,24 +49,43 @@ class DataGenerator(AbstractSeqModule):
         self.normalize = mean is not None
         
         self.frame_idx = 0
-        frames, annotations = dataset[self.sample_idx]
-        self.raw_frames = [frames[..., t].clone()
-                           for t in range(frames.shape[-1])]
-        temp_frames = frames.clone().permute([2, 1, 0, 3]) # CHWT to XYZT
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._next_sample = None
+        self._load_sample()
+
+    def _load_sample(self) -> None:
+        if self._next_sample is None:
+            frames, annotations = self.dataset[self.sample_idx]
+        else:
+            frames, annotations = self._next_sample.result()
+        # Normalization is done in numpy as the downstream modules only take
+        # numpy data. A torch sample is viewed as numpy without any copy.
+        if torch.is_tensor(frames):
+            raw_frames = frames
+            frames = frames.numpy()
+        else:
+            raw_frames = torch.from_numpy(frames)
+        # Raw frames are indexed in time as views of the CHWT sample. The
+        # dataset returns an independent array, so no copy is needed here.
+        # Consumers that modify the raw frame must clone it themselves.
+        self.raw_frames = raw_frames
+        temp_frames = frames.transpose([3, 2, 1, 0]) # CHWT to TXYZ
         if self.normalize:
-            temp_frames = (temp_frames - self.mean[None, None, :, None]
-                           ) / self.std[None, None, :, None]
-        self.frames = [temp_frames[..., t].cpu().data.numpy()
-                       for t in range(frames.shape[-1])]
+            # normalized into one C ordered TXYZ buffer so that every frame
+            # is a contiguous XYZ block
+            temp_frames = np.subtract(temp_frames, self.mean, order='C')
+            temp_frames /= self.std
+        self.frames = temp_frames
         self.annotations = annotations
         self.sample_idx += 1
-        
+        self._next_sample = self._executor.submit(self.dataset.__getitem__,
+                                                  self.sample_idx)
 
     def __call__(self) -> None:
         return super().__call__()
 
     def forward(self) -> None:
-        raw_frame = self.raw_frames[self.frame_idx]
+        raw_frame = self.raw_frames[..., self.frame_idx]
         frame = self.frames[self.frame_idx]
         annotation = self.annotations[self.frame_idx]
         self.frame_idx += 1
@@ -67,17 +94,7 @@ class DataGenerator(AbstractSeqModule):
     def post_forward(self) -> None:
         if self.frame_idx >= len(self.annotations):
             self.frame_idx = 0
-            frames, annotations = self.dataset[self.sample_idx]
-            self.raw_frames = [frames[..., t].clone()
-                               for t in range(frames.shape[-1])]
-            temp_frames = frames.clone().permute([2, 1, 0, 3]) # CHWT to XYZT
-            if self.normalize:
-                temp_frames = (temp_frames - self.mean[None, None, :, None]
-                               ) / self.std[None, None, :, None]
-            self.frames = [temp_frames[..., t].cpu().data.numpy()
-                           for t in range(frames.shape[-1])]
-            self.annotations = annotations
-            self.sample_idx += 1
+            self._load_sample()
 
 
 class YOLOPredictor(AbstractSeqModule):
@@ -88,6 +105,9 @@ class YOLOPredictor(AbstractSeqModule):
     the YOLO num_anchors * X * Y bounding box predictions in the order of
     x_center, y_center, width, height, confidence and one-hot classes.
 
+    If numba is available, the prediction is evaluated by a fused compiled
+    kernel. Otherwise, it falls back to numpy evaluation.
+
     Parameters
     ----------
     anchors : np.ndarray
@@ -102,35 +122,62 @@ class YOLOPredictor(AbstractSeqModule):
         self.anchors = anchors
         self.clamp_max = clamp_max
         self.num_anchors = anchors.shape[0]
+        self._grid_cache = {}
 
     def __call__(self, x: np.ndarray) -> np.ndarray:
         return super().__call__(x)
 
+    def _grid(self, W: int, H: int) -> Tuple[np.ndarray, ...]:
+        # Frame invariant terms, evaluated once per grid size: YX planes of
+        # the cell offsets normalized by the grid size and the anchor sizes
+        # normalized by the grid size.
+        if (W, H) not in self._grid_cache:
+            range_y, range_x = np.meshgrid(np.arange(H) / H,
+                                           np.arange(W) / W,
+                                           indexing='ij')
+            self._grid_cache[(W, H)] = (
+                range_x,
+                range_y,
+                (self.anchors[:, 0] / W)[:, None, None],
+                (self.anchors[:, 1] / H)[:, None, None],
+            )
+        return self._grid_cache[(W, H)]
+
     def forward(self, x: np.ndarray) -> np.ndarray:
         W, H, C = x.shape
-        P = C // self.num_anchors
-        x = x.reshape([W, H, self.num_anchors, P]).transpose([2, 1, 0, 3])
-
-        range_y, range_x = np.meshgrid(np.arange(H), np.arange(W),
-                                       indexing='ij')
-
-        anchor_x, anchor_y = self.anchors[:, 0], self.anchors[:, 1]
-        x_center = (sigmoid(x[:, :, :, 0:1]) + range_x[None, :, :, None]) / W
-        y_center = (sigmoid(x[:, :, :, 1:2]) + range_y[None, :, :, None]) / H
-        width = (np.exp(x[:, :, :, 2:3].clip(max=self.clamp_max))
-                 * anchor_x[:, None, None, None]) / W
-        height = (np.exp(x[:, :, :, 3:4].clip(max=self.clamp_max))
-                  * anchor_y[:, None, None, None]) / H
-        confidence = sigmoid(x[:, :, :, 4:5])
-        classes = softmax(x[:, :, :, 5:], axis=-1)
-
-        x = np.concatenate([x_center, y_center,
-                            width, height,
-                            confidence, classes], axis=-1)
-
-        x = x.reshape([-1, P])
-
-        return x
+        A = self.num_anchors
+        P = C // A
+        # same output dtype for both paths, at least float64 like the
+        # reference numpy formulation
+        dtype = np.result_type(x.dtype, self.anchors.dtype, np.float64)
+        if HAVE_NUMBA:
+            out = np.empty([A * H * W, P], dtype=dtype)
+            _yolo_decode(x, self.anchors, self.clamp_max, out)
+            return out
+
+        offset_x, offset_y, anchor_w, anchor_h = self._grid(W, H)
+        # the terms are evaluated in place on contiguous channel planes
+        # (PAYX) and transposed to the output order once at the end
+        planes = np.empty([P, A, H, W], dtype=dtype)
+        planes[...] = x.reshape([W, H, A, P]).transpose([3, 2, 1, 0])
+        # x_center & y_center
+        sigmoid(planes[0:2], out=planes[0:2])
+        planes[0] *= 1 / W
+        planes[0] += offset_x
+        planes[1] *= 1 / H
+        planes[1] += offset_y
+        # width & height
+        np.minimum(planes[2:4], self.clamp_max, out=planes[2:4])
+        np.exp(planes[2:4], out=planes[2:4])
+        planes[2] *= anchor_w
+        planes[3] *= anchor_h
+        # confidence
+        sigmoid(planes[4], out=planes[4])
+        # classes
+        if P > 5:
+            softmax(planes[5:], axis=0, out=planes[5:])
+
+        return planes.transpose([1, 2, 3, 0]).reshape([-1, P])
 
 
 class YOLOMonitor(AbstractSeqModule):
@@ -184,20 +231,24 @@ class YOLOMonitor(AbstractSeqModule):
         input_frame = self.input_frame_buffer.get()
         gt_bbox = self.gt_bbox_buffer.get()
         pred_bbox = self.pred_bbox_buffer.get()
-        self.ap_stats.update([torch.tensor(pred_bbox)],
-                             [torch.tensor(gt_bbox)])
+        # zero copy conversion, shared by all the calls below
+        if isinstance(pred_bbox, np.ndarray):
+            pred_bbox = torch.from_numpy(pred_bbox)
+        if isinstance(gt_bbox, np.ndarray):
+            gt_bbox = torch.from_numpy(gt_bbox)
+        self.ap_stats.update([pred_bbox], [gt_bbox])
         if self.events:
             annotated_frame = obd.bbox.utils.create_frames_events(
                 inputs=input_frame[None, ..., None],
-                targets=[[torch.tensor(gt_bbox)]],
-                predictions=[[torch.tensor(pred_bbox)]],
+                targets=[[gt_bbox]],
+                predictions=[[pred_bbox]],
                 classes=self.class_list,
                 box_color_map=self.box_color_map)[0]
         else:            
             annotated_frame = obd.bbox.utils.create_frames(
                 inputs=input_frame[None, ..., None],
-                targets=[[torch.tensor(gt_bbox)]],
-                predictions=[[torch.tensor(pred_bbox)]],
+                targets=[[gt_bbox]],
+                predictions=[[pred_bbox]],
                 classes=self.class_list,
                 box_color_map=self.box_color_map)[0]
         if self.viz_fx is not None:
@@ -205,10 +256,40 @@ class YOLOMonitor(AbstractSeqModule):
 
 
 class DeltaEncoder(AbstractSeqModule):
+    """Delta encoder module. On every call, it takes a fixed point frame and
+    returns the thresholded change with respect to the previously encoded
+    state.
+
+    Parameters
+    ----------
+    vth : Union[int, float]
+        Delta threshold.
+    spike_exp : Optional[int], optional
+        Fixed point exponent of the encoded output, by default 0.
+    num_bits : Optional[int], optional
+        Number of bits of the encoded output. If None, the output is not
+        clipped. By default None.
+    dtype : Optional[np.dtype], optional
+        Integer data type of the encoder arithmetic. If None, np.int16 is
+        used while the span of the shifted inputs seen so far fits in it and
+        the input dtype afterwards. By default None.
+
+    Raises
+    ------
+    RuntimeError
+        When the clipped output range or the span of the shifted inputs does
+        not fit in an explicitly specified `dtype`.
+    TypeError
+        When the input is not an integer array.
+
+    Note: the encoder state never exceeds the span of zero and the shifted
+    inputs seen so far.
+    """
     def __init__(self,
                  vth: Union[int, float],
                  spike_exp: Optional[int] = 0,
-                 num_bits: Optional[int] = None) -> None:
+                 num_bits: Optional[int] = None,
+                 dtype: Optional[np.dtype] = None) -> None:
         super().__init__()
         self.vth = vth * (1 << (spike_exp))
         self.spike_exp = spike_exp
@@ -221,17 +302,72 @@ class DeltaEncoder(AbstractSeqModule):
             a_min = a_max = -1
         self.a_min = a_min
         self.a_max = a_max
+        self.narrowed = dtype is None
+        if dtype is None:
+            dtype = np.int16
+        dtype = np.dtype(dtype)
+        info = np.iinfo(dtype)
+        if num_bits is not None and (a_min < info.min or a_max > info.max):
+            if not self.narrowed:
+                raise RuntimeError(f"{num_bits=} with {spike_exp=} exceeds "
+                                   f"the range of {dtype}.")
+            dtype = None
+        self.dtype = dtype
+        # running range of the shifted input, including the zero state
+        self.in_min = 0
+        self.in_max = 0
 
     def encode_delta(self, act_new):
-        delta = act_new - self.act + self.residue
-        s_out = np.where(np.abs(delta) >= self.vth, delta, 0)
-        if self.a_max > 0:
-            s_out = np.clip(s_out, a_min=self.a_min, a_max=self.a_max)
-        self.residue = delta - s_out
+        if np.shape(self.residue) != act_new.shape:
+            # state buffers are allocated on the first call
+            self.residue = np.zeros(act_new.shape, dtype=act_new.dtype)
+            self.act = np.zeros(act_new.shape, dtype=act_new.dtype)
+            self._delta = np.empty(act_new.shape, dtype=act_new.dtype)
+            self._mask = np.empty(act_new.shape, dtype=bool)
+        elif self.residue.dtype != act_new.dtype:
+            # widen the state after a fall back from narrowed arithmetic
+            self.residue = self.residue.astype(act_new.dtype)
+            self.act = self.act.astype(act_new.dtype)
+            self._delta = np.empty(act_new.shape, dtype=act_new.dtype)
+        s_out = np.empty(act_new.shape, dtype=act_new.dtype)
+        if HAVE_NUMBA and act_new.dtype.kind == 'i':
+            _delta_encode(act_new.reshape(-1), self.act.reshape(-1),
+                          self.residue.reshape(-1), self.vth,
+                          self.a_min, self.a_max, s_out.reshape(-1))
+        else:
+            delta = self._delta
+            np.subtract(act_new, self.act, out=delta)
+            delta += self.residue
+            np.abs(delta, out=s_out)
+            np.less(s_out, self.vth, out=self._mask)
+            np.copyto(s_out, delta)
+            np.copyto(s_out, 0, where=self._mask)
+            if self.a_max > 0:
+                np.clip(s_out, self.a_min, self.a_max, out=s_out)
+            np.subtract(delta, s_out, out=self.residue)
         self.act = act_new
         return s_out
 
     def forward(self, a_in: np.ndarray) -> np.ndarray:
+        a_in = np.asarray(a_in)
+        if a_in.dtype.kind not in 'biu':
+            raise TypeError(f'DeltaEncoder expects integer input. '
+                            f'Found {a_in.dtype}.')
+        if self.dtype is not None and a_in.size > 0:
+            in_min = min(self.in_min, int(a_in.min()) << self.spike_exp)
+            in_max = max(self.in_max, int(a_in.max()) << self.spike_exp)
+            info = np.iinfo(self.dtype)
+            if in_min < info.min or in_max - in_min > info.max:
+                if not self.narrowed:
+                    raise RuntimeError(
+                        f'Shifted input span [{in_min}, {in_max}] exceeds '
+                        f'the range of {self.dtype}.'
+                    )
+                self.dtype = None  # fall back to the input dtype
+            self.in_min = in_min
+            self.in_max = in_max
+        if self.dtype is not None:
+            a_in = a_in.astype(self.dtype, copy=False)
         a_in_data = np.left_shift(a_in, self.spike_exp)
         return self.encode_delta(a_in_data)
 
@@ -243,17 +379,105 @@ def nms(predictions: np.ndarray,
         merge_conf: bool = True,
         max_detections: int = 300,
         max_iterations: int = 100) -> np.ndarray:
-    return obd.boundingbox.utils.nms([torch.tensor(predictions)],
-                                     conf_threshold,
-                                     nms_threshold,
-                                     merge_conf,
-                                     max_detections,
-                                     max_iterations)[0].cpu().data.numpy()
-
-
-def sigmoid(x: np.ndarray) -> np.ndarray:
-    return 1.0 / (1.0 + np.exp(-x))
-
-
-def softmax(x: np.ndarray, axis=None) -> np.ndarray:
-    return np.exp(x) / np.sum(np.exp(x), axis=axis, keepdims=True)
+    return nms_batch([predictions],
+                     conf_threshold,
+                     nms_threshold,
+                     merge_conf,
+                     max_detections,
+                     max_iterations)[0]
+
+
+def nms_batch(predictions: List[np.ndarray],
+              conf_threshold: float = 0.5,
+              nms_threshold: float = 0.4,
+              merge_conf: bool = True,
+              max_detections: int = 300,
+              max_iterations: int = 100) -> List[np.ndarray]:
+    result = obd.boundingbox.utils.nms([torch.from_numpy(p)
+                                        for p in predictions],
+                                       conf_threshold,
+                                       nms_threshold,
+                                       merge_conf,
+                                       max_detections,
+                                       max_iterations)
+    return [r.cpu().numpy() for r in result]
+
+
+def sigmoid(x: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    # evaluated in place in the output buffer, no temporaries
+    if out is None:
+        out = np.empty(x.shape, dtype=np.result_type(x.dtype, np.float32))
+    np.negative(x, out=out)
+    np.exp(out, out=out)
+    out += 1
+    np.reciprocal(out, out=out)
+    return out
+
+
+def softmax(x: np.ndarray,
+            axis: Optional[int] = None,
+            out: Optional[np.ndarray] = None) -> np.ndarray:
+    # numerically stable softmax with a single exp evaluation
+    if out is None:
+        out = np.empty(x.shape, dtype=np.result_type(x.dtype, np.float32))
+    np.subtract(x, np.max(x, axis=axis, keepdims=True), out=out)
+    np.exp(out, out=out)
+    out /= np.sum(out, axis=axis, keepdims=True)
+    return out
+
+
+if HAVE_NUMBA:
+    @njit(parallel=True, fastmath=True)
+    def _yolo_decode(x: np.ndarray,
+                     anchors: np.ndarray,
+                     clamp_max: float,
+                     out: np.ndarray) -> None:
+        # Fused YOLOPredictor evaluation of XYF input x. The result is written
+        # to out in (anchor, y, x) row order.
+        W, H, C = x.shape
+        A = anchors.shape[0]
+        P = C // A
+        inv_w = 1.0 / W
+        inv_h = 1.0 / H
+        for aj in prange(A * H):
+            a = aj // H
+            j = aj % H
+            anchor_w = anchors[a, 0] * inv_w
+            anchor_h = anchors[a, 1] * inv_h
+            for i in range(W):
+                row = aj * W + i
+                p = a * P
+                out[row, 0] = (1.0 / (1.0 + np.exp(-x[i, j, p])) + i) * inv_w
+                out[row, 1] = ((1.0 / (1.0 + np.exp(-x[i, j, p + 1])) + j)
+                               * inv_h)
+                out[row, 2] = np.exp(min(x[i, j, p + 2], clamp_max)) * anchor_w
+                out[row, 3] = np.exp(min(x[i, j, p + 3], clamp_max)) * anchor_h
+                out[row, 4] = 1.0 / (1.0 + np.exp(-x[i, j, p + 4]))
+                if P > 5:
+                    x_max = x[i, j, p + 5]
+                    for k in range(6, P):
+                        x_max = max(x_max, x[i, j, p + k])
+                    total = 0.0
+                    for k in range(5, P):
+                        out[row, k] = np.exp(x[i, j, p + k] - x_max)
+                        total += out[row, k]
+                    for k in range(5, P):
+                        out[row, k] /= total
+
+    @njit(fastmath=True)
+    def _delta_encode(act_new: np.ndarray,
+                      act: np.ndarray,
+                      residue: np.ndarray,
+                      vth: Union[int, float],
+                      a_min: int,
+                      a_max: int,
+                      s_out: np.ndarray) -> None:
+        # Fused DeltaEncoder update of flattened arrays. The residue is
+        # updated in place.
+        for i in range(act_new.shape[0]):
+            delta = act_new[i] - act[i] + residue[i]
+            s = delta if abs(delta) >= vth else 0
+            if a_max > 0:
+                s = min(max(s, a_min), a_max)
+            s_out[i] = s
+            residue[i] = delta - s